@@ -8,6 +8,7 @@
 3. INCLUDE_EXTENSION_IN_NAME: 文件名是否包含扩展名
 4. HIDE_MARKER: 隐藏标记
 5. FILENAME_SEPARATOR: 文件名连接符号
+6. OUTPUT_FORMAT: 输出格式（files: 逐个文件 / tar: 打包为单个 combined.tar）
 
 v3.2 新增:
 - 支持 (a=b) 重定向格式：分裂时丢弃源标签分支
@@ -16,9 +17,19 @@ v3.2 新增:
 import os
 import sys
 import re
-from typing import List, Dict, Set, Tuple
+import io
+import array
+import codecs
+import hashlib
+import mmap
+import tarfile
+from collections import deque
+from typing import Callable, Deque, Iterator, List, Dict, FrozenSet, Optional, Tuple
 from dataclasses import dataclass, field
 from copy import deepcopy
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 
 
 @dataclass
@@ -29,8 +40,9 @@ class FileInfo:
     base_name: str
     name_no_ext: str
     extension: str
-    tags: Set[str] = field(default_factory=set)
-    content: str = ""
+    tags: FrozenSet[str] = frozenset()
+    sorted_tags: Tuple[str, ...] = ()  # 分裂时按此顺序生成子分支，输出顺序不随哈希种子变化
+    content: bytes = b""  # 原始字节；大文件为只读 mmap
     group_order: int = 0
     should_hide: bool = False  # 是否在输出文件名中隐藏
     kill_tag: str = ""  # 重定向时要删除的源标签 (a=b 中的 a)
@@ -43,32 +55,52 @@ class GroupInfo:
     name: str
     folder_path: str
     files: List[FileInfo] = field(default_factory=list)
+    tagged_files: List[FileInfo] = field(default_factory=list)
+    untagged_files: List[FileInfo] = field(default_factory=list)
+    tag_index: Dict[str, List[int]] = field(default_factory=dict)  # 标签 → files 中的下标（升序）
 
 
 @dataclass
 class Branch:
-    """分支（树枝）"""
-    files: List[FileInfo]
-    accumulated_tags: Set[str]
-    
-    def copy(self) -> 'Branch':
-        return Branch(
-            files=self.files.copy(),
-            accumulated_tags=self.accumulated_tags.copy()
-        )
+    """分支（树枝）
+    
+    以父指针链表示路径：子分支只引用父分支，不复制已走过的文件列表。
+    """
+    parent: Optional['Branch']
+    file: FileInfo
+    accumulated_tags: FrozenSet[str]
+    _path_str: Optional[str] = field(default=None, init=False, repr=False, compare=False)
     
-    def add_file(self, file_info: FileInfo, new_tags: Set[str]):
-        self.files.append(file_info)
-        self.accumulated_tags = new_tags
+    @property
+    def files(self) -> List[FileInfo]:
+        """从根到当前节点的文件列表（沿父指针回溯后反转）"""
+        files = []
+        node = self
+        while node is not None:
+            files.append(node.file)
+            node = node.parent
+        files.reverse()
+        return files
     
     def get_path_str(self) -> str:
-        return ' → '.join([f.orig_name for f in self.files])
+        # 路径字符串按需生成并缓存，子分支复用父分支已拼好的前缀
+        if self._path_str is None:
+            if self.parent is None:
+                self._path_str = self.file.orig_name
+            else:
+                self._path_str = f"{self.parent.get_path_str()} → {self.file.orig_name}"
+        return self._path_str
 
 
 class ConfigManager:
     """配置管理器"""
     
+    LOG_PREFIXES = {"INFO": "ℹ️", "SUCCESS": "✅", "WARNING": "⚠️", "ERROR": "❌"}
+    OUTPUT_FORMATS = ('files', 'tar')
+    LOG_BUFFER_LINES = 1024  # 缓冲模式下每累积这么多行日志写出一次
+    
     def __init__(self):
+        self._log_buffer: Optional[List[str]] = None
         self.config_dir = os.getenv('CONFIG_DIR', 'configs')  # 源文件文件夹
         self.output_dir = os.getenv('OUTPUT_DIR', '.')  # ".":输出到根目录
         self.separator = self._parse_separator(os.getenv('SEPARATOR', '\n\n'))
@@ -81,73 +113,117 @@ class ConfigManager:
         self.include_extension_in_name = os.getenv('INCLUDE_EXTENSION_IN_NAME', 'false').lower() == 'true'
         self.hide_marker = os.getenv('HIDE_MARKER', '[hide]')  # 隐藏标记
         self.filename_separator = os.getenv('FILENAME_SEPARATOR', '-')  # 文件名连接符
+        self.output_format = os.getenv('OUTPUT_FORMAT', 'files').lower()  # files/tar
+        # tar 成员的修改时间取固定值，内容不变时归档逐字节相同（支持 SOURCE_DATE_EPOCH）
+        source_date_epoch = os.getenv('SOURCE_DATE_EPOCH', '0')
+        self.tar_mtime = int(source_date_epoch) if source_date_epoch.isdigit() else 0
         
         # 其他配置
         self.enable_tag_matching = os.getenv('ENABLE_TAG_MATCHING', 'true').lower() == 'true'
         self.tag_format = os.getenv('TAG_FORMAT', 'bracket')
         self.verbose = os.getenv('VERBOSE', 'true').lower() == 'true'
         
+        if self.output_format not in self.OUTPUT_FORMATS:
+            self.log(f"未知的输出格式: {self.output_format} (可选: files/tar)，按 files 输出", "WARNING")
+            self.output_format = 'files'
+        
     @staticmethod
     def _parse_separator(sep_str: str) -> str:
         return sep_str.replace('\\n', '\n').replace('\\t', '\t')
     
     def log(self, message: str, level: str = "INFO"):
         if self.verbose:
-            prefix = {"INFO": "ℹ️", "SUCCESS": "✅", "WARNING": "⚠️", "ERROR": "❌"}.get(level, "•")
-            print(f"{prefix} {message}")
+            prefix = self.LOG_PREFIXES.get(level, "•")
+            line = f"{prefix} {message}"
+            if self._log_buffer is None:
+                print(line)
+                return
+            self._log_buffer.append(line)
+            if len(self._log_buffer) >= self.LOG_BUFFER_LINES:
+                self._flush_log()
+    
+    @contextmanager
+    def buffered_log(self):
+        """组合阶段的逐分支日志成块写出：每块一次 write，而不是每行一次 print"""
+        self._log_buffer = []
+        try:
+            yield
+        finally:
+            self._flush_log()
+            self._log_buffer = None
+    
+    def _flush_log(self):
+        if self._log_buffer:
+            sys.stdout.write('\n'.join(self._log_buffer) + '\n')
+            self._log_buffer.clear()
 
 
 class TagExtractor:
     """标签提取器"""
     
-    PATTERNS = {
-        'bracket': r'\(([^)]+)\)',
-        'bracket-cn': r'（([^）]+)）',
-        'both': r'[（(]([^）)]+?)[）)]',
+    # 各标签格式的 (左括号, 右括号) 字符；用 str.find 扫描，不经过正则引擎
+    # 语义与正则 [左]([^右]+)[右] 一致：取左括号后第一个右括号，括号内不能为空
+    BRACKETS = {
+        'bracket': ('(', ')'),
+        'bracket-cn': ('（', '）'),
+        'both': ('(（', ')）'),
     }
     
-    @classmethod
-    def extract_tags(cls, filename: str, tag_format: str = 'both') -> Set[str]:
-        """提取普通标签（逗号分隔）"""
-        pattern = cls.PATTERNS.get(tag_format, cls.PATTERNS['both'])
-        match = re.search(pattern, filename)
-        if not match:
-            return set()
-        tags_str = match.group(1)
-        tags = [tag.strip() for tag in re.split('[,，]', tags_str) if tag.strip()]
-        return set(tags)
+    @staticmethod
+    def _find_any(text: str, chars: str, start: int) -> int:
+        """返回 chars 中任一字符在 text[start:] 中最早出现的位置，找不到为 -1"""
+        found = -1
+        for ch in chars:
+            idx = text.find(ch, start)
+            if idx != -1 and (found == -1 or idx < found):
+                found = idx
+        return found
     
     @classmethod
-    def remove_tags(cls, filename: str, tag_format: str = 'both') -> str:
-        """移除标签"""
-        pattern = cls.PATTERNS.get(tag_format, cls.PATTERNS['both'])
-        return re.sub(pattern, '', filename, count=1).strip()
+    def _iter_brackets(cls, filename: str, tag_format: str) -> Iterator[Tuple[int, int]]:
+        """依次产出每个括号标签的 (左括号下标, 右括号下标)"""
+        openers, closers = cls.BRACKETS.get(tag_format, cls.BRACKETS['both'])
+        pos = 0
+        while True:
+            start = cls._find_any(filename, openers, pos)
+            if start == -1:
+                return
+            end = cls._find_any(filename, closers, start + 1)
+            if end == -1:
+                return
+            if end == start + 1:
+                # 空括号不算标签，从下一个字符继续找
+                pos = start + 1
+                continue
+            yield start, end
+            pos = end + 1
+    
+    @staticmethod
+    def _split_tags(content: str) -> List[str]:
+        return [tag.strip() for tag in content.replace('，', ',').split(',') if tag.strip()]
     
     @classmethod
-    def extract_redirect_info(cls, filename: str, tag_format: str = 'both') -> Tuple[Set[str], str, str]:
+    @lru_cache(maxsize=4096)
+    def parse(cls, filename: str, tag_format: str = 'both') -> Tuple[FrozenSet[str], str, str, str, str]:
         """
-        提取标签信息（支持重定向格式 a=b）
+        一次性解析文件名（结果按 (filename, tag_format) 缓存）
         
         Returns:
-            (tags, clean_name, kill_tag)
+            (tags, clean_name, name_no_ext, extension, kill_tag)
             - tags: 所有标签集合（包括源标签和目标标签）
-            - clean_name: 清理后的文件名
+            - clean_name: 清理后的文件名（移除第一个括号标签）
+            - name_no_ext / extension: clean_name 拆分后的文件名与扩展名
             - kill_tag: 重定向时要删除的源标签（空字符串表示无重定向）
         """
-        pattern = cls.PATTERNS.get(tag_format, cls.PATTERNS['both'])
-        
         tags = set()
         kill_tag = ""
-        clean_name = filename
+        first_span = None
         
         # 找到所有括号内容
-        matches = list(re.finditer(pattern, filename))
-        
-        if not matches:
-            return tags, filename, kill_tag
-        
-        for match in matches:
-            content = match.group(1)
+        for start, end in cls._iter_brackets(filename, tag_format):
+            if first_span is None:
+                first_span = (start, end)
+            content = filename[start + 1:end]
             
             # 检查是否是重定向格式 a=b
             if '=' in content:
@@ -161,74 +237,91 @@ class TagExtractor:
                         kill_tag = src
             else:
                 # 普通标签 a,b,c
-                for tag in re.split('[,，]', content):
-                    tag = tag.strip()
-                    if tag:
-                        tags.add(tag)
+                tags.update(cls._split_tags(content))
         
-        # 清理文件名（移除第一个括号标签）
-        clean_name = re.sub(pattern, '', filename, count=1).strip()
+        if first_span is None:
+            clean_name = filename
+        else:
+            # 清理文件名（切片移除第一个括号标签）
+            clean_name = (filename[:first_span[0]] + filename[first_span[1] + 1:]).strip()
         
-        return tags, clean_name, kill_tag
+        name_no_ext, extension = os.path.splitext(clean_name)
+        return frozenset(tags), clean_name, name_no_ext, extension, kill_tag
 
 
 class FolderScanner:
     """文件夹扫描器"""
     
     FOLDER_PATTERN = re.compile(r'^\(([0-9]+)\)-\s*(.+)$')
+    MAX_READ_WORKERS = 32
+    MMAP_THRESHOLD = 64 << 10  # 不小于此大小的文件用 mmap 映射，不复制进内存
+    UTF8_CHECK_CHUNK = 1 << 20
     
     @classmethod
     def scan_groups(cls, config_dir: str, config: ConfigManager) -> List[GroupInfo]:
-        if not os.path.exists(config_dir):
+        # 直接打开目录，不存在时由异常得知，省去单独的 exists 检查
+        try:
+            dir_iter = os.scandir(config_dir)
+        except FileNotFoundError:
             config.log(f"配置目录不存在: {config_dir}", "ERROR")
             return []
         
         groups = []
-        for folder_name in os.listdir(config_dir):
-            folder_path = os.path.join(config_dir, folder_name)
-            if not os.path.isdir(folder_path):
-                continue
-            
-            match = cls.FOLDER_PATTERN.match(folder_name)
-            if match:
-                order = int(match.group(1))
-                name = match.group(2).strip()
-            else:
-                config.log(f"跳过: {folder_name} (格式: (数字)-组名)", "WARNING")
-                continue
-            
-            group = GroupInfo(order=order, name=name, folder_path=folder_path)
-            group.files = cls._scan_files(folder_path, config, order)
-            groups.append(group)
-            config.log(f"发现分组 [{order}] {name}: {len(group.files)} 个文件")
+        blob_pool = {}  # 内容摘要 → 内容，所有分组共用
+        # scandir 的 DirEntry 自带类型信息，省去逐项 isdir 的 stat 调用
+        with dir_iter as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                
+                folder_name = entry.name
+                folder_path = entry.path
+                match = cls.FOLDER_PATTERN.match(folder_name)
+                if match:
+                    order = int(match.group(1))
+                    name = match.group(2).strip()
+                else:
+                    config.log(f"跳过: {folder_name} (格式: (数字)-组名)", "WARNING")
+                    continue
+                
+                group = GroupInfo(order=order, name=name, folder_path=folder_path)
+                group.files = cls._scan_files(folder_path, config, order, blob_pool)
+                cls._index_files(group)
+                groups.append(group)
+                config.log(f"发现分组 [{order}] {name}: {len(group.files)} 个文件")
         
         groups.sort(key=lambda g: g.order)
         return groups
     
     @classmethod
-    def _scan_files(cls, folder_path: str, config: ConfigManager, group_order: int) -> List[FileInfo]:
+    def _scan_files(cls, folder_path: str, config: ConfigManager, group_order: int,
+                    blob_pool: Dict[bytes, bytes]) -> List[FileInfo]:
         files = []
-        for filename in os.listdir(folder_path):
-            file_path = os.path.join(folder_path, filename)
-            if not os.path.isfile(file_path):
-                continue
-            
-            # 检查是否包含隐藏标记
-            should_hide = config.hide_marker in filename
+        marker = config.hide_marker
+        with os.scandir(folder_path) as it:
+            entries = [(entry.name, entry.path) for entry in it if entry.is_file()]
+        # 目录遍历顺序取决于文件系统，按文件名排序使每次运行的输出顺序一致
+        entries.sort()
+        
+        for filename, file_path in entries:
+            # 检查是否包含隐藏标记（find 一次同时得到位置）
+            marker_idx = filename.find(marker)
+            should_hide = marker_idx != -1
             if should_hide:
                 config.log(f"文件 {filename} 包含隐藏标记，将在输出文件名中忽略", "INFO")
+                # 移除隐藏标记后再处理标签和名称；标记之前的部分无需再扫描
+                clean_filename = (
+                    filename[:marker_idx]
+                    + filename[marker_idx + len(marker):].replace(marker, '')
+                )
+            else:
+                clean_filename = filename
             
-            # 移除隐藏标记后再处理标签和名称
-            clean_filename = filename.replace(config.hide_marker, '') if should_hide else filename
-            
-            # 使用新的提取方法（支持重定向）
-            tags, base_name_no_tags, kill_tag = TagExtractor.extract_redirect_info(
+            # 一次解析出标签、名称与扩展名（支持重定向）
+            tags, base_name_no_tags, name_no_ext, extension, kill_tag = TagExtractor.parse(
                 clean_filename, config.tag_format
             )
             
-            # 进一步分离文件名和扩展名
-            name_no_ext, extension = os.path.splitext(base_name_no_tags)
-            
             # 如果有重定向，记录日志
             if kill_tag:
                 dst_tags = tags - {kill_tag}
@@ -237,13 +330,6 @@ class FolderScanner:
                     "INFO"
                 )
             
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-            except Exception as e:
-                config.log(f"读取失败 {filename}: {e}", "ERROR")
-                continue
-            
             file_info = FileInfo(
                 path=file_path,
                 orig_name=filename,
@@ -251,18 +337,116 @@ class FolderScanner:
                 name_no_ext=name_no_ext,
                 extension=extension,
                 tags=tags,
-                content=content,
+                sorted_tags=tuple(sorted(tags)),
                 group_order=group_order,
                 should_hide=should_hide,
                 kill_tag=kill_tag
             )
             files.append(file_info)
-        return files
+        
+        if not files:
+            return files
+        
+        # 读取是 I/O 密集型操作，用线程池并发读取并计算摘要（读取和哈希期间释放 GIL）
+        with ThreadPoolExecutor(max_workers=min(cls.MAX_READ_WORKERS, len(files))) as executor:
+            futures = [executor.submit(cls._read_content, f.path) for f in files]
+        
+        loaded = []
+        for file_info, future in zip(files, futures):
+            try:
+                digest, data = future.result()
+                file_info.content = cls._intern_blob(digest, data, blob_pool)
+            except Exception as e:
+                config.log(f"读取失败 {file_info.orig_name}: {e}", "ERROR")
+                continue
+            loaded.append(file_info)
+        return loaded
+    
+    @staticmethod
+    def _intern_blob(digest: bytes, data: bytes, blob_pool: Dict[bytes, bytes]) -> bytes:
+        """内容相同的文件共享同一份数据（按读取时算好的 blake2b 摘要去重）"""
+        shared = blob_pool.setdefault(digest, data)
+        if shared is not data and isinstance(data, mmap.mmap):
+            data.close()
+        return shared
+    
+    @staticmethod
+    def release(groups: List[GroupInfo]):
+        """关闭扫描时建立的 mmap 映射"""
+        for group in groups:
+            for file_info in group.files:
+                if isinstance(file_info.content, mmap.mmap):
+                    file_info.content.close()
+    
+    @staticmethod
+    def _index_files(group: GroupInfo):
+        """预先分离有/无标签文件，并建立 标签 → 文件下标 的倒排索引"""
+        for idx, file_info in enumerate(group.files):
+            if not file_info.tags:
+                group.untagged_files.append(file_info)
+                continue
+            group.tagged_files.append(file_info)
+            for tag in file_info.tags:
+                group.tag_index.setdefault(tag, []).append(idx)
+    
+    @classmethod
+    def _read_content(cls, path: str) -> Tuple[bytes, bytes]:
+        """
+        读取文件原始字节，输出时直接写出，省去解码再编码
+        
+        仍按文本模式的规则处理：内容必须是合法 UTF-8，
+        且 \r\n、\r 统一转换为 \n。
+        返回 (blake2b 摘要, 内容)，摘要在读取线程中计算，供去重使用。
+        """
+        # 直接使用底层文件描述符，绕过 BufferedReader：open/fstat/read/close
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            size = os.fstat(fd).st_size
+            if size >= cls.MMAP_THRESHOLD:
+                data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            else:
+                data = cls._read_fd(fd, size)
+        finally:
+            os.close(fd)
+        
+        cls._check_utf8(data)
+        if data.find(b'\r') != -1:
+            data = bytes(data).replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        return hashlib.blake2b(data, digest_size=16).digest(), data
+    
+    @staticmethod
+    def _read_fd(fd: int, size: int) -> bytes:
+        """按 fstat 得到的大小一次读完；遇到短读或文件变长时继续读到 EOF"""
+        chunks = []
+        while True:
+            chunk = os.read(fd, size + 1)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+    
+    @classmethod
+    def _check_utf8(cls, data: bytes):
+        """分块校验 UTF-8，不生成完整的解码字符串"""
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        with memoryview(data) as view:
+            for start in range(0, len(view), cls.UTF8_CHECK_CHUNK):
+                with view[start:start + cls.UTF8_CHECK_CHUNK] as chunk:
+                    decoder.decode(chunk)
+        decoder.decode(b'', final=True)
 
 
 class TreeBranchCombiner:
     """树形分支组合器"""
     
+    # 写入是 I/O 密集型：线程数按 CPU 数放大；每个线程同一时刻只占用一个文件描述符
+    MAX_WRITE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+    WRITE_BATCH_SIZE = 32  # 每个写入任务携带的输出文件数，摊薄任务调度开销
+    # 在途批次上限：每个线程最多两批，超出后先收集已完成的写入，避免结果和片段堆积到运行结束
+    MAX_PENDING_BATCHES = MAX_WRITE_WORKERS * 2
+    TAR_NAME = 'combined.tar'  # OUTPUT_FORMAT=tar 时的输出文件名
+    IOV_MAX = 1024  # 单次 writev 的最大片段数（Linux 的 IOV_MAX）
+    
     def __init__(self, config: ConfigManager, groups: List[GroupInfo]):
         self.config = config
         self.groups = groups
@@ -273,6 +457,29 @@ class TreeBranchCombiner:
             'tag_discontinuity_warnings': 0,
             'redirected_branches': 0
         }
+        self._write_pool: Optional[ThreadPoolExecutor] = None
+        # 尚未提交的一批写入：(输出文件名, 片段列表, 分支文件列表)，文件列表留到收集结果时复用；
+        # 片段列表为 None 表示沿用同名输出上一次写入的结果
+        self._batch: List[Tuple[str, List[bytes], List[FileInfo]]] = []
+        # 已提交的批次及其写入结果，按提交顺序收集
+        self._pending_writes: Deque[Tuple[Future, List[Tuple[str, List[bytes], List[FileInfo]]]]] = deque()
+        # 输出文件名 → 最近一次写入它的批次，用于保持同名输出"后写覆盖"的顺序
+        self._writes_by_path: Dict[str, Future] = {}
+        # 输出文件名 → 最近一次写入的内容键，以及最近一次收集到的写入错误（只记录失败），整个运行期间保留
+        self._content_keys_by_path: Dict[str, bytes] = {}
+        self._failed_writes: Dict[str, Exception] = {}
+        # 相同的标签组合共享同一个 frozenset 对象
+        self._interned_tags: Dict[FrozenSet[str], FrozenSet[str]] = {}
+        # 分隔符只编码一次；输出路径前缀只拼接一次
+        self._separator_bytes = config.separator.encode('utf-8')
+        self._output_prefix = os.path.join(config.output_dir, '')
+        self._output_dir_fd: Optional[int] = None
+        self._tar: Optional[tarfile.TarFile] = None
+        self._tar_error: Optional[Exception] = None
+        self._extension_resolver = self._build_extension_resolver()
+    
+    def _intern_tags(self, tags: FrozenSet[str]) -> FrozenSet[str]:
+        return self._interned_tags.setdefault(tags, tags)
     
     def combine(self) -> int:
         """主组合流程"""
@@ -286,17 +493,56 @@ class TreeBranchCombiner:
         
         os.makedirs(self.config.output_dir, exist_ok=True)
         
+        if self.config.output_format == 'tar':
+            # 大量小文件时逐个创建文件的元数据开销很大：改为顺序写入单个 tar 流
+            self._tar = tarfile.open(self._output_prefix + self.TAR_NAME, 'w|')
+            try:
+                self._grow_branches()
+            finally:
+                self._tar.close()
+                self._tar = None
+        else:
+            # 输出文件按批交给线程池并发写入，边生长边收集已完成的写入
+            self._open_output_dir()
+            self._write_pool = ThreadPoolExecutor(max_workers=self.MAX_WRITE_WORKERS)
+            try:
+                self._grow_branches()
+                self._submit_batch()
+            finally:
+                self._write_pool.shutdown(wait=True)
+                if self._output_dir_fd is not None:
+                    os.close(self._output_dir_fd)
+                    self._output_dir_fd = None
+        self._collect_writes()
+        
+        return self.stats['output_files']
+    
+    def _open_output_dir(self):
+        """
+        打开输出目录的文件描述符，之后按文件名相对它创建输出文件，
+        避免每次写入都重新解析整条目录路径（平台不支持时退回完整路径）
+        """
+        if os.open not in os.supports_dir_fd or not hasattr(os, 'O_DIRECTORY'):
+            return
+        self._output_dir_fd = os.open(self.config.output_dir, os.O_RDONLY | os.O_DIRECTORY)
+        self._output_prefix = ''
+    
+    def _grow_branches(self):
+        """逐层生长分支，并提交需要输出的分支"""
         # 初始化：从第一层的所有文件开始创建分支
         current_branches = []
+        next_branches = []
         first_group = self.groups[0]
         
         for file_info in first_group.files:
             branch = Branch(
-                files=[file_info],
-                accumulated_tags=file_info.tags.copy()
+                parent=None,
+                file=file_info,
+                accumulated_tags=self._intern_tags(file_info.tags)
             )
             current_branches.append(branch)
-            self.config.log(f"初始化分支: {branch.get_path_str()} [标签: {branch.accumulated_tags}]")
+            if self.config.verbose:
+                self.config.log(f"初始化分支: {branch.get_path_str()} [标签: {set(branch.accumulated_tags)}]")
         
         # 逐层处理
         for layer_idx in range(1, len(self.groups)):
@@ -306,15 +552,19 @@ class TreeBranchCombiner:
             self.config.log(f"当前分支数: {len(current_branches)}")
             self.config.log(f"{'='*60}")
             
-            new_branches, output_branches = self._process_layer(
-                current_branches, current_group
-            )
+            # 每层只选一次匹配函数：没有标签文件的层走无标签专用路径
+            if current_group.tagged_files:
+                match_branch = self._match_branch_to_layer
+            else:
+                match_branch = self._match_branch_to_untagged_layer
             
-            # 输出提前终止的分支
-            for branch in output_branches:
-                self._output_file(branch)
+            # 子分支直接写入复用的缓冲区，本层终止的分支立即提交输出
+            for branch in current_branches:
+                if match_branch(branch, current_group, next_branches):
+                    self._output_file(branch)
             
-            current_branches = new_branches
+            current_branches, next_branches = next_branches, current_branches
+            next_branches.clear()
             
             if not current_branches:
                 self.config.log("所有分支已终止", "WARNING")
@@ -323,52 +573,39 @@ class TreeBranchCombiner:
         # 输出剩余分支
         for branch in current_branches:
             self._output_file(branch)
-        
-        return self.stats['output_files']
     
-    def _process_layer(self, branches: List[Branch], group: GroupInfo) -> Tuple[List[Branch], List[Branch]]:
-        """处理一层"""
-        new_branches = []
-        terminated_branches = []
-        
-        for branch in branches:
-            branch_new, branch_terminated = self._match_branch_to_layer(branch, group)
-            new_branches.extend(branch_new)
-            if branch_terminated:
-                terminated_branches.append(branch)
+    def _match_branch_to_layer(self, branch: Branch, group: GroupInfo, out: List[Branch]) -> bool:
+        """
+        将一个分支匹配到一层
         
-        return new_branches, terminated_branches
-    
-    def _match_branch_to_layer(self, branch: Branch, group: GroupInfo) -> Tuple[List[Branch], bool]:
-        """将一个分支匹配到一层"""
+        存活的子分支直接追加到 out 中；返回该分支是否在本层终止。
+        """
         files = group.files
-        
-        # 分离有标签和无标签文件
-        tagged_files = [f for f in files if f.tags]
-        untagged_files = [f for f in files if not f.tags]
+        start = len(out)
+        matched = False
         
         # ========================================
         # 第一步：处理有标签文件（连通即分裂）
         # ========================================
-        new_branches = []
+        # 判断是否连通：
+        # - 空分支（初始状态）：连通，允许接纳任何标签
+        # - 有标签分支：必须有交集才算连通，直接从倒排索引取出候选文件
+        if branch.accumulated_tags:
+            positions = set()
+            for tag in branch.accumulated_tags:
+                positions.update(group.tag_index.get(tag, ()))
+            connected_files = [files[idx] for idx in sorted(positions)]
+        else:
+            connected_files = group.tagged_files
         
-        for file_info in tagged_files:
-            # 1. 计算交集
-            common_tags = branch.accumulated_tags & file_info.tags
-            
-            # 2. 判断是否连通
-            # - 空分支（初始状态）：连通，允许接纳任何标签
-            # - 有标签分支：必须有交集才算连通
-            is_connected = not branch.accumulated_tags or bool(common_tags)
-            
-            if is_connected:
-                # ✅ 连通成功！文件的所有标签都是合法路径
-                for tag in file_info.tags:
-                    new_branch = branch.copy()
-                    new_branch.add_file(file_info, {tag})
-                    new_branches.append(new_branch)
-                    
-                    # 日志区分：继承 vs 分裂
+        for file_info in connected_files:
+            # ✅ 连通成功！文件的所有标签都是合法路径
+            for tag in file_info.sorted_tags:
+                matched = True
+                new_branch = Branch(parent=branch, file=file_info, accumulated_tags=self._intern_tags(frozenset((tag,))))
+                
+                # 日志区分：继承 vs 分裂
+                if self.config.verbose:
                     if tag in branch.accumulated_tags:
                         self.config.log(
                             f"  标签继承: {branch.get_path_str()} → {file_info.orig_name} "
@@ -379,99 +616,238 @@ class TreeBranchCombiner:
                             f"  路径分裂: {branch.get_path_str()} → {file_info.orig_name} "
                             f"[新增标签: {tag}]"
                         )
+                
+                # ✨ 重定向补丁：分支标签正好是该文件的 kill_tag 时丢弃该分支
+                if tag == file_info.kill_tag:
+                    # 🗑️ 丢弃这个分支（实现"重定向"效果）
+                    if self.config.verbose:
+                        # 找到目标标签
+                        dst_tags = file_info.tags - {file_info.kill_tag}
+                        dst_tag_str = ', '.join(dst_tags) if dst_tags else '?'
+                        self.config.log(
+                            f"  分支丢弃: {new_branch.get_path_str()} "
+                            f"[标签 '{file_info.kill_tag}' 已转为 '{dst_tag_str}']",
+                            "WARNING"
+                        )
+                    self.stats['redirected_branches'] += 1
+                    continue
+                
+                out.append(new_branch)
         
         # ========================================
         # 第二步：如果没有任何标签文件匹配，才尝试无标签文件
         # ========================================
-        if not new_branches:
-            for file_info in untagged_files:
-                new_branch = branch.copy()
-                new_branch.add_file(file_info, branch.accumulated_tags.copy())
-                new_branches.append(new_branch)
-                
-                self.config.log(
-                    f"  匹配成功: {branch.get_path_str()} → {file_info.orig_name} "
-                    f"[保持标签: {branch.accumulated_tags or '无'}]"
-                )
+        if not matched:
+            self._extend_untagged(branch, group, out)
         
         # ========================================
         # 第三步：处理终止情况
         # ========================================
-        if not new_branches:
-            self.config.log(
-                f"  分支终止: {branch.get_path_str()} [在当前层无匹配]",
-                "WARNING"
-            )
-            return [], True
-        
-        # ========================================
-        # ✨ 第四步：应用重定向补丁——删除需要被丢弃的分支
-        # ========================================
-        final_branches = []
-        for nb in new_branches:
-            # 获取该分支最新添加的文件
-            last_file = nb.files[-1]
+        return self._is_terminated(branch, out, start, matched)
+    
+    def _match_branch_to_untagged_layer(self, branch: Branch, group: GroupInfo, out: List[Branch]) -> bool:
+        """将一个分支匹配到只有无标签文件的一层（无需标签连通判断）"""
+        start = len(out)
+        self._extend_untagged(branch, group, out)
+        return self._is_terminated(branch, out, start, False)
+    
+    def _extend_untagged(self, branch: Branch, group: GroupInfo, out: List[Branch]):
+        """将分支接到本层每个无标签文件上，保持原有标签"""
+        for file_info in group.untagged_files:
+            # 标签集合不会被原地修改，可直接与父分支共享
+            out.append(Branch(parent=branch, file=file_info, accumulated_tags=branch.accumulated_tags))
             
-            # 检查是否满足删除条件：
-            # 1. 该文件有 kill_tag 属性
-            # 2. 当前分支的标签正好是 kill_tag
-            if last_file.kill_tag and nb.accumulated_tags == {last_file.kill_tag}:
-                # 找到目标标签
-                dst_tags = last_file.tags - {last_file.kill_tag}
-                dst_tag_str = ', '.join(dst_tags) if dst_tags else '?'
-                
-                # 🗑️ 丢弃这个分支（实现"重定向"效果）
+            if self.config.verbose:
                 self.config.log(
-                    f"  分支丢弃: {nb.get_path_str()} "
-                    f"[标签 '{last_file.kill_tag}' 已转为 '{dst_tag_str}']",
+                    f"  匹配成功: {branch.get_path_str()} → {file_info.orig_name} "
+                    f"[保持标签: {set(branch.accumulated_tags) or '无'}]"
+                )
+    
+    def _is_terminated(self, branch: Branch, out: List[Branch], start: int, matched: bool) -> bool:
+        """本层没有留下任何子分支时，分支终止"""
+        if len(out) == start:
+            if self.config.verbose:
+                # 有匹配却没有留下分支，说明唯一匹配的分支被重定向"吃掉"了
+                reason = "被重定向吃掉" if matched else "在当前层无匹配"
+                self.config.log(
+                    f"  分支终止: {branch.get_path_str()} [{reason}]",
                     "WARNING"
                 )
-                self.stats['redirected_branches'] += 1
-                continue
-            
-            final_branches.append(nb)
+            return True
         
-        # 如果删光了，说明唯一匹配的分支被重定向"吃掉"了，视为终止
-        if not final_branches:
-            self.config.log(
-                f"  分支终止: {branch.get_path_str()} [被重定向吃掉]",
-                "WARNING"
-            )
-            return [], True
-        
-        return final_branches, False
+        return False
 
     def _output_file(self, branch: Branch):
         """输出文件"""
-        if not branch.files:
+        files = branch.files
+        if not files:
             return
         
-        output_filename = self._build_output_filename(branch.files)
-        output_path = os.path.join(self.config.output_dir, output_filename)
+        output_filename = self._build_output_filename(files)
         
-        contents = [f.content for f in branch.files]
-        combined_content = self.config.separator.join(contents)
+        # 同名输出且各段内容完全相同（内容已按摘要共享，比较对象即可）时跳过重写，
+        # 沿用上一次写入的结果
+        # 内容键按 8 字节整数打包，整轮保留时占用远小于整数元组
+        content_key = array.array('Q', [id(f.content) for f in files]).tobytes()
+        if self._content_keys_by_path.get(output_filename) == content_key:
+            if self._tar is not None:
+                self._record_write(output_filename, files, self._failed_writes.get(output_filename))
+            else:
+                self._batch.append((output_filename, None, files))
+            return
         
+        # 内容与分隔符交错成片段列表，直接逐段写入，不再拼成一个大字符串
+        separator = self._separator_bytes
+        parts = []
+        for file_info in files:
+            if parts:
+                parts.append(separator)
+            parts.append(file_info.content)
+        
+        if self._tar is not None:
+            # tar 流只能顺序追加：同步写入并立即统计
+            error = self._add_to_tar(output_filename, parts)
+            self._content_keys_by_path[output_filename] = content_key
+            self._note_write_error(output_filename, error)
+            self._record_write(output_filename, files, error)
+            return
+        self._content_keys_by_path[output_filename] = content_key
+        
+        # 同名输出必须保持"后写覆盖"的顺序：同一批内按顺序写入，
+        # 前一次写入在已提交的批中时先等待它完成
+        previous = self._writes_by_path.get(output_filename)
+        if previous is not None:
+            wait([previous])
+        
+        self._batch.append((output_filename, parts, files))
+        if len(self._batch) >= self.WRITE_BATCH_SIZE:
+            self._submit_batch()
+    
+    def _submit_batch(self):
+        """提交当前批的写入，在途批次过多时先收集最早提交的结果"""
+        batch = self._batch
+        if not batch:
+            return
+        self._batch = []
+        
+        future = self._write_pool.submit(self._write_batch, self._output_prefix, batch, self._output_dir_fd)
+        for output_filename, parts, _ in batch:
+            if parts is not None:
+                self._writes_by_path[output_filename] = future
+        self._pending_writes.append((future, batch))
+        
+        self._collect_writes(self.MAX_PENDING_BATCHES)
+    
+    def _add_to_tar(self, name: str, parts: List[bytes]) -> Optional[Exception]:
+        """
+        将一个输出文件追加到 tar 流，返回写入失败的异常（成功时为 None）
+        
+        流式写入失败后归档内容已不可靠：不再追加，之后的输出都按同一错误计为失败
+        """
+        if self._tar_error is not None:
+            return self._tar_error
         try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(combined_content)
-            
-            self.stats['output_files'] += 1
-            
-            tag_info = self._get_tag_info(branch.files)
-            warning_msg = self._check_tag_discontinuity(tag_info, branch.files)
-            
+            data = b''.join(parts)
+            info = tarfile.TarInfo(name=name)
+            info.size = len(data)
+            info.mtime = self.config.tar_mtime
+            info.mode = 0o644
+            self._tar.addfile(info, io.BytesIO(data))
+        except Exception as e:
+            self._tar_error = e
+            return e
+        return None
+    
+    @classmethod
+    def _write_batch(cls, prefix: str, batch: List[Tuple[str, List[bytes], List[FileInfo]]],
+                     dir_fd: Optional[int] = None) -> List[Optional[Exception]]:
+        """按顺序写出一批文件，返回每个文件写入失败的异常（成功时为 None）"""
+        errors = []
+        for name, parts, _ in batch:
+            if parts is None:
+                errors.append(None)
+                continue
+            try:
+                cls._write_parts(prefix + name, parts, dir_fd)
+            except Exception as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+    
+    @classmethod
+    def _write_parts(cls, path: str, parts: List[bytes], dir_fd: Optional[int] = None):
+        # 直接写文件描述符；支持 writev 时一次系统调用写出所有片段，无需先拼接
+        fd = os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666,
+            dir_fd=dir_fd
+        )
+        views = []
+        try:
+            views = [memoryview(part) for part in parts if len(part)]
+            idx = 0
+            while idx < len(views):
+                if hasattr(os, 'writev'):
+                    written = os.writev(fd, views[idx:idx + cls.IOV_MAX])
+                else:
+                    written = os.write(fd, views[idx])
+                # 跳过已写完的片段，部分写入的片段只保留剩余部分
+                while written and written >= len(views[idx]):
+                    written -= len(views[idx])
+                    idx += 1
+                if written:
+                    rest = views[idx][written:]
+                    views[idx].release()
+                    views[idx] = rest
+        finally:
+            # 显式释放视图，不依赖引用计数立即回收：视图仍在时 mmap 无法关闭
+            for view in views:
+                view.release()
+            os.close(fd)
+    
+    def _collect_writes(self, limit: int = 0):
+        """按提交顺序收集写入结果，直到在途批次不超过 limit"""
+        pending = self._pending_writes
+        while len(pending) > limit:
+            future, batch = pending.popleft()
+            for (output_filename, parts, files), error in zip(batch, future.result()):
+                # 按顺序收集：跳过的输出取到的总是它之前那次同名写入的结果
+                if parts is None:
+                    error = self._failed_writes.get(output_filename)
+                else:
+                    self._note_write_error(output_filename, error)
+                # 该文件名之后没有再提交写入时，不再需要记录它
+                if self._writes_by_path.get(output_filename) is future:
+                    del self._writes_by_path[output_filename]
+                self._record_write(output_filename, files, error)
+    
+    def _note_write_error(self, output_filename: str, error: Optional[Exception]):
+        if error is None:
+            self._failed_writes.pop(output_filename, None)
+        else:
+            self._failed_writes[output_filename] = error
+    
+    def _record_write(self, output_filename: str, files: List[FileInfo], error: Optional[Exception]):
+        """更新一次输出的统计并输出日志"""
+        if error is not None:
+            # 输出文件相对目录描述符创建时，异常里只有文件名：补上输出目录便于定位
+            self.config.log(f"写入失败 {os.path.join(self.config.output_dir, output_filename)}: {error}", "ERROR")
+            return
+        
+        self.stats['output_files'] += 1
+        
+        tag_info = self._get_tag_info(files)
+        warning_msg = self._check_tag_discontinuity(tag_info, files)
+        
+        if self.config.verbose:
             self.config.log(
-                f"输出文件: {output_filename} ({branch.get_path_str()}) "
+                f"输出文件: {output_filename} ({' → '.join(f.orig_name for f in files)}) "
                 f"[标签: {tag_info}]{' ' + warning_msg if warning_msg else ''}",
                 "SUCCESS"
             )
-            
-            if warning_msg:
-                self.stats['tag_discontinuity_warnings'] += 1
-            
-        except Exception as e:
-            self.config.log(f"写入失败: {e}", "ERROR")
+        
+        if warning_msg:
+            self.stats['tag_discontinuity_warnings'] += 1
 
     def _build_output_filename(self, files: List[FileInfo]) -> str:
         """
@@ -488,15 +864,11 @@ class TreeBranchCombiner:
         if not visible_files:
             visible_files = [files[0]]
         
-        # 构建基础文件名（所有标签都已去掉）
-        name_parts = []
-        for file_info in visible_files:
-            if self.config.include_extension_in_name:
-                # base_name 已经去掉了标签
-                name_parts.append(file_info.base_name)
-            else:
-                # name_no_ext 也已经去掉了标签
-                name_parts.append(file_info.name_no_ext)
+        # 构建基础文件名：base_name / name_no_ext 在扫描时已去掉标签，这里只做拼接
+        if self.config.include_extension_in_name:
+            name_parts = [f.base_name for f in visible_files]
+        else:
+            name_parts = [f.name_no_ext for f in visible_files]
         
         # 使用配置的连接符连接
         base_name = self.config.filename_separator.join(name_parts)
@@ -520,29 +892,31 @@ class TreeBranchCombiner:
         if not files:
             return ''
         
-        if self.config.extension_mode == 'first':
-            return files[0].extension
-        elif self.config.extension_mode == 'last':
-            return files[-1].extension
-        elif self.config.extension_mode == 'none':
-            return ''
-        elif self.config.extension_mode == 'custom':
+        return self._extension_resolver(files)
+    
+    def _build_extension_resolver(self) -> Callable[[List[FileInfo]], str]:
+        """根据扩展名模式只做一次分派，之后每个输出文件直接调用"""
+        mode = self.config.extension_mode
+        if mode == 'last':
+            return lambda files: files[-1].extension
+        elif mode == 'none':
+            return lambda files: ''
+        elif mode == 'custom':
             # 确保自定义扩展名以点开头
             ext = self.config.custom_extension
             if ext and not ext.startswith('.'):
                 ext = '.' + ext
-            return ext
+            return lambda files: ext
         else:
-            return files[0].extension
+            # first 以及未知模式：以第一个文件为准
+            return lambda files: files[0].extension
     
     def _get_tag_info(self, files: List[FileInfo]) -> Dict[str, List[int]]:
         """获取标签使用信息"""
         tag_info = {}
         for file_info in files:
             for tag in file_info.tags:
-                if tag not in tag_info:
-                    tag_info[tag] = []
-                tag_info[tag].append(file_info.group_order)
+                tag_info.setdefault(tag, []).append(file_info.group_order)
         return tag_info
     
     def _check_tag_discontinuity(self, tag_info: Dict[str, List[int]], branch_files: List[FileInfo]) -> str:
@@ -555,8 +929,8 @@ class TreeBranchCombiner:
         Returns:
             警告信息字符串
         """
-        # 收集所有经过的分组序号和无标签文件所在的分组
-        all_group_orders = set(f.group_order for f in branch_files)
+        # 收集所有经过的分组序号（升序）和无标签文件所在的分组
+        branch_orders = sorted(set(f.group_order for f in branch_files))
         untagged_group_orders = set(f.group_order for f in branch_files if not f.tags)
         
         warnings = []
@@ -568,9 +942,8 @@ class TreeBranchCombiner:
             min_group = min(groups_set)
             max_group = max(groups_set)
             
-            # 只检查分支实际经过的分组范围内的缺失
-            expected_groups = set(range(min_group, max_group + 1)) & all_group_orders
-            missing = sorted(expected_groups - groups_set)
+            # 只检查分支实际经过的分组范围内的缺失（直接扫描经过的分组，不构造整段 range）
+            missing = [g for g in branch_orders if min_group < g < max_group and g not in groups_set]
             
             if missing:
                 # 检查缺失的分组是否使用了无标签文件
@@ -613,6 +986,7 @@ def main():
     config.log(f"隐藏标记: {config.hide_marker}")
     config.log(f"文件名连接符: '{config.filename_separator}'")
     config.log(f"分隔符: {repr(config.separator)}")
+    config.log(f"输出格式: {config.output_format}")
     
     print("\n" + "-"*60)
     print("扫描分组...")
@@ -627,6 +1001,9 @@ def main():
     print(f"\n找到 {len(groups)} 个分组")
     for group in groups:
         print(f"  [{group.order}] {group.name}: {len(group.files)} 个文件")
+        # 逐文件明细只在详细模式下输出，分组汇总始终保留
+        if not config.verbose:
+            continue
         for f in group.files:
             tags_str = f" (标签: {', '.join(f.tags)})" if f.tags else " (无标签)"
             redirect_str = f" [重定向: {f.kill_tag}→{','.join(f.tags - {f.kill_tag})}]" if f.kill_tag else ""
@@ -637,7 +1014,11 @@ def main():
     print("开始组合（树形分支算法）...")
     print("-"*60)
     combiner = TreeBranchCombiner(config, groups)
-    file_count = combiner.combine()
+    try:
+        with config.buffered_log():
+            file_count = combiner.combine()
+    finally:
+        FolderScanner.release(groups)
     
     combiner.print_stats()
     print(f"\n✅ 完成！共生成 {file_count} 个文件")